@@ -1,3 +1,4 @@
+import datetime
 import os
 from dotenv import load_dotenv
 from sqlalchemy import (
@@ -10,18 +11,38 @@ from sqlalchemy import (
     String,
     SmallInteger,
     ForeignKey,
+    exists,
+    Index,
+    insert,
+    select,
+    update,
 )
+from sqlalchemy.dialects.postgresql import insert as pg_insert
 from sqlalchemy.exc import SQLAlchemyError
-from sqlalchemy.orm import declarative_base, relationship, scoped_session, sessionmaker
+from sqlalchemy.orm import declarative_base, relationship, sessionmaker
 from sqlalchemy.sql import func
 
 # Load the dotenv and create a logger
 load_dotenv("./credentials.env")
 
 # Create the SQL Alchemy ORM.
-engine = create_engine(os.getenv("CONNECTION_STRING"), echo=False, pool_size=20)
-session_factory = sessionmaker(bind=engine)
-Session = scoped_session(session_factory)
+# The psycopg2 executemany mode batches the multi row statements, with the inserts being sent as multi row VALUES pages.
+# The pool is shared by the main and sub region threads, the connections are checked and recycled since the workers can sleep for long periods.
+# If multiprocessing is ever used, call engine.dispose() on each child process before using the engine.
+engine = create_engine(
+    os.getenv("CONNECTION_STRING"),
+    echo=False,
+    pool_size=8,
+    max_overflow=16,
+    pool_pre_ping=True,
+    pool_recycle=1800,
+    executemany_mode="values_plus_batch",
+    insertmanyvalues_page_size=1000,
+)
+# Maximum number of rows sent and committed at once by insert_data_list.
+INSERT_BATCH_SIZE = int(os.getenv("INSERT_BATCH_SIZE", 500))
+# Each helper opens it's own short lived session, so no state is kept between calls on the worker threads.
+Session = sessionmaker(bind=engine, expire_on_commit=False)
 Base = declarative_base()
 
 
@@ -42,9 +63,10 @@ class Rating(Base):
             "MASTER",
             "GRANDMASTER",
             "CHALLENGER",
+            name="tier",
         )
     )
-    rank = Column(Enum("IV", "III", "II", "I"))
+    rank = Column(Enum("IV", "III", "II", "I", name="rank"))
     summonerId = Column(String(63))
     leaguePoints = Column(SmallInteger)
     wins = Column(SmallInteger)
@@ -52,6 +74,9 @@ class Rating(Base):
     region = Column(String(4))
     fetchTime = Column(DateTime, default=func.now())
 
+    # Index for getting the last rating of a given summoner.
+    __table_args__ = (Index("ix_rating_summoner_time", summonerId, fetchTime.desc()),)
+
 
 # Class model for player info related data.
 class Player(Base):
@@ -66,7 +91,11 @@ class Player(Base):
     profileIconId = Column(SmallInteger)
     lastMatchFetch = Column(DateTime, default="2024-05-1 00:00:01")
     region = Column(String(4))
-    stats = relationship("Stats", back_populates="player")
+    # The stats are never loaded implicitly, use selectinload on the queries that need them.
+    stats = relationship("Stats", back_populates="player", lazy="raise")
+
+    # Index for getting the next player to fetch from a list of regions.
+    __table_args__ = (Index("ix_player_region_lastfetch", region, lastMatchFetch),)
 
 
 # Class model for match related data.
@@ -75,13 +104,14 @@ class Match(Base):
 
     id = Column(Integer, primary_key=True)
     gameVersion = Column(String(15))
-    matchId = Column(String(20))
+    matchId = Column(String(20), unique=True, index=True)
     matchStart = Column(DateTime)
     matchDuration = Column(Integer)
     matchWinner = Column(Boolean)
     matchSurrender = Column(Boolean)
     matchRemake = Column(Boolean)
-    stats = relationship("Stats", back_populates="match")
+    # The stats are never loaded implicitly, use selectinload on the queries that need them.
+    stats = relationship("Stats", back_populates="match", lazy="raise")
 
 
 # Class model for stats related data.
@@ -126,7 +156,16 @@ class Stats(Base):
     wardsPlaced = Column(SmallInteger)
     wardsKilled = Column(SmallInteger)
     teamPosition = Column(
-        Enum("TOP", "JUNGLE", "MIDDLE", "BOTTOM", "UTILITY", "Invalid", "")
+        Enum(
+            "TOP",
+            "JUNGLE",
+            "MIDDLE",
+            "BOTTOM",
+            "UTILITY",
+            "Invalid",
+            "",
+            name="team_position",
+        )
     )
     team = Column(Boolean)
     player = relationship("Player", back_populates="stats")
@@ -138,6 +177,7 @@ Base.metadata.create_all(engine)
 
 def insert_data_list(data, model):
     """Generic function for inserting lists of data into the database.
+    The data is split into batches of INSERT_BATCH_SIZE rows, each one committed on it's own.
 
     Args:
         data (List[Dict]): List of dictionaries to be inserted into the passed model.
@@ -146,15 +186,16 @@ def insert_data_list(data, model):
     Raises:
         Exception: Raises an exception showing in which model the error occurred.
     """
-    session = Session()
+    # An empty parameter list would insert a single row with only the default values.
+    if not data:
+        return
     try:
-        session.bulk_insert_mappings(model, data)
-        session.commit()
+        with Session() as session:
+            for i in range(0, len(data), INSERT_BATCH_SIZE):
+                with session.begin():
+                    session.execute(insert(model), data[i : i + INSERT_BATCH_SIZE])
     except SQLAlchemyError as e:
-        session.rollback()
         raise Exception(f"Error inserting data on model: {model}, error: {e}")
-    finally:
-        session.close()
 
 
 def insert_player_rating_list(data_list):
@@ -166,47 +207,93 @@ def insert_player_rating_list(data_list):
     insert_data_list(data_list, Rating)
 
 
-def insert_match(data):
+def insert_match(session, data):
     """Function to insert a single match info into the database.
+    Matches that are already on the database are ignored.
 
     Args:
+        session (Session): Session of the transaction the insertion is part of.
         data (Dict): Dictionary containing the data to insert into the database.
 
     Raises:
         Exception: Exception showing where the error happened.
+
+    Returns:
+        Number OR None: Id of the inserted match on the Matches table, None if the match was already on the database.
     """
-    session = Session()
     try:
-        session.add(Match(**data))
-        session.commit()
+        return session.execute(
+            pg_insert(Match)
+            .values(**data)
+            .on_conflict_do_nothing(index_elements=["matchId"])
+            .returning(Match.id)
+        ).scalar()
     except SQLAlchemyError as e:
-        session.rollback()
         raise Exception(f"Error occurred on match insertion: {e}")
-    finally:
-        session.close()
 
 
-def insert_player_list(data_list):
-    """Wrapper for inserting a list of players into the database.
+def insert_player_list(session, data_list):
+    """Function to insert a list of players into the database.
+    Players that are already on the database are ignored.
 
     Args:
+        session (Session): Session of the transaction the insertion is part of.
         data_list (List[Dict]): List of dictonaries containing the treated player data.
+
+    Raises:
+        Exception: Exception showing where the error happened.
+
+    Returns:
+        Dict: Dictionary mapping each inserted player puuid to it's id on the Player's table.
     """
-    insert_data_list(data_list, Player)
+    if not data_list:
+        return {}
+    try:
+        rows = session.execute(
+            pg_insert(Player)
+            .values(data_list)
+            .on_conflict_do_nothing(index_elements=["puuid"])
+            .returning(Player.puuid, Player.id)
+        ).all()
+        return dict(rows)
+    except SQLAlchemyError as e:
+        raise Exception(f"Error occurred on player insertion: {e}")
 
 
-def insert_stats_list(data_list):
+def insert_stats_list(session, data_list, player_ids=None, match_ids=None):
     """
     Function to get the player id and match id as integers from the database.
     Wrapper for inserting data into the database.
+    Ids already known by the caller are reused, the remaining ones are fetched with a single query per table.
 
     Args:
+        session (Session): Session of the transaction the insertion is part of.
         data_list (List[Dict]): List of dictonaries containing the treated stats data.
+        player_ids (Dict, optional): Dictionary mapping puuids to player ids. Defaults to None.
+        match_ids (Dict, optional): Dictionary mapping match ids to their ids on the Matches table. Defaults to None.
     """
+    player_map = dict(player_ids or {})
+    match_map = dict(match_ids or {})
+    puuids = {stat["playerId"] for stat in data_list} - player_map.keys()
+    missing_matches = {stat["matchId"] for stat in data_list} - match_map.keys()
+    if puuids:
+        player_map.update(
+            session.query(Player.puuid, Player.id)
+            .filter(Player.puuid.in_(puuids))
+            .all()
+        )
+    if missing_matches:
+        match_map.update(
+            session.query(Match.matchId, Match.id)
+            .filter(Match.matchId.in_(missing_matches))
+            .all()
+        )
     for stat in data_list:
-        stat["playerId"] = get_player_id(stat["playerId"])
-        stat["matchId"] = get_match_id(stat["matchId"])
-    insert_data_list(data_list, Stats)
+        stat["playerId"] = player_map.get(stat["playerId"])
+        stat["matchId"] = match_map.get(stat["matchId"])
+    # An empty parameter list would insert a single row with only the default values.
+    if data_list:
+        session.execute(insert(Stats), data_list)
 
 
 def safe_query(func):
@@ -232,12 +319,12 @@ def get_next_to_fetch(regions):
         Dict OR None: Returns a dict containing the player puuid and lastMatchFetch if the data was found. Otherwise, returns None.
     """
     with Session() as session:
-        player = (
-            session.query(Player)
+        player = session.execute(
+            select(Player.puuid, Player.lastMatchFetch)
+            .where(Player.region.in_(regions))
             .order_by(Player.lastMatchFetch)
-            .filter(Player.region.in_(regions))
-            .first()
-        )
+            .limit(1)
+        ).first()
         return (
             {"puuid": player.puuid, "lastFetch": player.lastMatchFetch}
             if player
@@ -246,94 +333,111 @@ def get_next_to_fetch(regions):
 
 
 @safe_query
-def get_player_id(puuid):
-    """Function to return a player id based on it's puuid.
-    Assumes the player is already registered since this function is only called after player insertion.
+def claim_next_to_fetch(regions):
+    """Function to get the next player to fetch the data from and set it's last fetch date as the current time.
+    The player row is locked while claimed and locked rows are skipped, so concurrent workers never get the same player.
 
     Args:
-        puuid (String): Unique identifier for the player.
+        regions (List[String]): List of regions that the player to be fetched can be.
 
     Returns:
-        Number: Player id on the Player's table.
+        Dict OR None: Returns a dict containing the player puuid and the lastMatchFetch before the claim if the data was found. Otherwise, returns None.
     """
-    with Session() as session:
-        player = session.query(Player).filter(Player.puuid == puuid).first()
-        return player.id if player else None
+    with Session() as session, session.begin():
+        player = session.execute(
+            select(Player.puuid, Player.lastMatchFetch)
+            .where(Player.region.in_(regions))
+            .order_by(Player.lastMatchFetch)
+            .limit(1)
+            .with_for_update(skip_locked=True)
+        ).first()
+        if player is None:
+            return None
+        session.execute(
+            update(Player)
+            .where(Player.puuid == player.puuid)
+            .values(lastMatchFetch=datetime.datetime.now())
+        )
+        return {"puuid": player.puuid, "lastFetch": player.lastMatchFetch}
 
 
 @safe_query
-def get_match_id(match_id):
-    """Function to return a match id based on it's match id.
-    Assumes the match is already registered since this function is only called after match insertion.
+def update_player_if_newer(session, player, matchDate):
+    """Function to update a player's information with a single conditional UPDATE if the match is older than the player's last fetch.
 
     Args:
-        puuid (String): Unique identifier for the match.
+        session (Session): Session of the transaction the update is part of.
+        player (dict): Dictionary containing the player's data
+        matchDate (datetime): Start date of the match where the player data came from.
 
     Returns:
-        Number: Match id on the Matches table.
+        bool: Returns True if the player was updated, else False.
     """
-    with Session() as session:
-        match = session.query(Match).filter(Match.matchId == match_id).first()
-        return match.id
-
-
-@safe_query
-def update_last_fetch(puuid):
-    """Function to update the last fetch date from a given player to set it as the current time.
-    Assures that the same player will not be fetched unless there is no other player whose data need to be fetched first.
-
-    Args:
-        puuid (String): Unique identifier for the player that will be updated.
-    """
-    with Session() as session:
-        player = session.query(Player).filter(Player.puuid == puuid).first()
-        player.lastMatchFetch = func.now()
-        session.commit()
+    result = session.execute(
+        update(Player)
+        .where(Player.puuid == player["puuid"], Player.lastMatchFetch > matchDate)
+        .values(
+            summonerId=player["summonerId"],
+            gameName=player["gameName"],
+            tagLine=player["tagLine"],
+            summonerLevel=player["summonerLevel"],
+            profileIconId=player["profileIconId"],
+            lastMatchFetch=matchDate,
+            region=player["region"],
+        )
+    )
+    return result.rowcount > 0
 
 
 @safe_query
-def update_player_if_exists(player, matchDate):
-    """Function to verify if a player is on the database.
+def insert_match_data(match_info, player_list, stats_list, claimed_puuid=None):
+    """Function to insert a treated match with it's players and stats in a single transaction.
+    If any insertion fails nothing is kept, so a match is never stored without it's stats.
 
     Args:
-        puuid (dict): Dictionary containing the player's data
+        match_info (Dict): Dictionary containing the treated match data.
+        player_list (List[Dict]): List of dictionaries containing the treated player data.
+        stats_list (List[Dict]): List of dictionaries containing the treated stats data.
+        claimed_puuid (String, optional): Puuid of the player being fetched, which isn't updated since it's last fetch was set when claimed. Defaults to None.
 
     Returns:
-        dict: Returns a dictionary containing the player information if the player is on the database.
+        bool: Returns True if the match was inserted, False if it was already on the database.
     """
-    with Session() as session:
-        player_exists = (
-            session.query(Player).filter(Player.puuid == player["puuid"]).first()
-        )
-        if not player_exists:
+    with Session() as session, session.begin():
+        # Insert the match first, if it was already inserted by another worker then it's data is skipped.
+        match_id = insert_match(session, match_info)
+        if match_id is None:
             return False
-
-        if player_exists.lastMatchFetch > matchDate:
-            # Update the player's information
-            player_exists.summonerId = player["summonerId"]
-            player_exists.gameName = player["gameName"]
-            player_exists.tagLine = player["tagLine"]
-            player_exists.summonerLevel = player["summonerLevel"]
-            player_exists.profileIconId = player["profileIconId"]
-            player_exists.lastMatchFetch = matchDate
-            player_exists.region = player["region"]
-            session.commit()
+        # Insert the new players, the ones already on the database are ignored by the insertion.
+        player_ids = insert_player_list(session, player_list)
+        for player in player_list:
+            # Only the players that already existed are updated.
+            if player["puuid"] in player_ids or player["puuid"] == claimed_puuid:
+                continue
+            update_player_if_newer(session, player, match_info["matchStart"])
+        # The ids returned by the insertions are reused for the stats, so only the already existing players are queried.
+        insert_stats_list(
+            session, stats_list, player_ids, {match_info["matchId"]: match_id}
+        )
         return True
 
 
 @safe_query
-def match_on_db(match_id):
-    """Function to verify if a match is on the database.
+def existing_match_ids(match_ids):
+    """Function to verify which matches of a list are already on the database.
 
     Args:
-        match_id (String): Unique identifier for the match.
+        match_ids (List[String]): List of unique identifiers for the matches.
 
     Returns:
-        bool: Returns True if the match is on the database, else False.
+        Set[String]: Set containing the match ids that are already on the database.
     """
+    if not match_ids:
+        return set()
     with Session() as session:
-        match_exists = session.query(Match).filter(Match.matchId == match_id).first()
-        return True if match_exists else False
+        return set(
+            session.scalars(select(Match.matchId).where(Match.matchId.in_(match_ids)))
+        )
 
 
 @safe_query
@@ -362,10 +466,7 @@ def main_region_is_started(region_list):
         bool: Returns True if any record of a player of the passed regions is found, False otherwise.
     """
     with Session() as session:
-        region_count = (
-            session.query(Player).filter(Player.region.in_(region_list)).count()
-        )
-        return True if region_count > 0 else False
+        return session.scalar(select(exists().where(Player.region.in_(region_list))))
 
 
 def insert_starting_point(player, region):
@@ -375,31 +476,36 @@ def insert_starting_point(player, region):
         player (dict): Dictionary with simple player data.
         region (string): Region where the player will be inserted.
     """
-    if get_player_id(player["puuid"]) != None:
-        return
     new_player = {
         "puuid": player["puuid"],
         "profileIconId": player["profileIconId"],
         "region": region,
         "summonerId": player["id"],
     }
-    insert_player_list([new_player])
+    with Session() as session, session.begin():
+        insert_player_list(session, [new_player])
 
 
 @safe_query
-def rating_up_to_date(rating):
+def latest_ratings_for(summoner_ids):
+    """Function to get the last rating of each summoner from a list.
+
+    Args:
+        summoner_ids (List[String]): List of summoner ids to get the last rating.
+
+    Returns:
+        Dict: Dictionary with the summoner id as key and a tuple of (leaguePoints, wins, losses) from it's last rating as value.
+    """
+    if not summoner_ids:
+        return {}
     with Session() as session:
-        last_rating = (
-            session.query(Rating)
-            .filter(Rating.summonerId == rating["summonerId"])
-            .order_by(Rating.fetchTime)
-            .first()
+        rows = session.execute(
+            select(Rating.summonerId, Rating.leaguePoints, Rating.wins, Rating.losses)
+            .where(Rating.summonerId.in_(summoner_ids))
+            .distinct(Rating.summonerId)
+            .order_by(Rating.summonerId, Rating.fetchTime.desc())
         )
-        if last_rating:
-            if (
-                last_rating.leaguePoints == rating["leaguePoints"]
-                and last_rating.wins == rating["wins"]
-                and last_rating.losses == rating["losses"]
-            ):
-                return True
-        return False
+        return {
+            summoner_id: (league_points, wins, losses)
+            for summoner_id, league_points, wins, losses in rows
+        }
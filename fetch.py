@@ -2,7 +2,9 @@ import requests
 import os
 import time
 from dotenv import load_dotenv
+from requests.adapters import HTTPAdapter
 from requests.exceptions import RequestException
+from threading import Lock
 
 # Load the environment variables.
 load_dotenv("./credentials.env")
@@ -26,41 +28,57 @@ class BaseFetcher:
     def __init__(self, region):
         self.api_key = os.getenv("API_KEY")
         self.region = region
-        self.retry_timer = 0
-        self.retry_count = 0
+        # Monotonic time until which no request is sent, shared by all the threads using this fetcher.
+        self.retry_until = 0
+        self.retry_lock = Lock()
+        # Maximum number of retries for server errors, with a exponential backoff between them.
+        self.max_retries = 3
         self.session = requests.Session()
+        # Set the token once for the session and keep the connections alive between requests.
+        self.session.headers.update({"X-Riot-Token": self.api_key})
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=32, max_retries=0)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
 
     def fetch(self, url: str):
         """Fetch data from the API with handling of rate limiting."""
+        # The retry count is kept per call, since a fetcher can be used by several threads at the same time.
+        retry_count = 0
         while True:
             # Verify if the rate limit was reached, if it was, then sleep until requests are available again.
-            if self.retry_timer > 0:
-                time.sleep(self.retry_timer)
-                self.retry_timer = 0
+            # The deadline is checked again after sleeping, since another thread can extend it meanwhile.
+            with self.retry_lock:
+                wait = self.retry_until - time.monotonic()
+            if wait > 0:
+                time.sleep(wait)
+                continue
             # Try block to treating temporary connection failures.
             try:
                 # Get the response from the server.
-                response = self.session.get(
-                    url, headers={"X-Riot-Token": f"{self.api_key}"}
-                )
-                # Verify if the response is valid, then reset the retry counter and return it as json.
+                response = self.session.get(url)
+                # Verify if the response is valid, then return it as json.
                 if response.status_code == 200:
-                    self.retry_count = 0
                     return response.json()
-                # If the response is invalid and related to rate limit, then set the retry timer to be used for sleep.
+                # If the response is invalid and related to rate limit, then push the retry deadline for every thread.
+                # A shorter Retry-After never shortens a deadline already set by another thread.
                 elif response.status_code == 429:
-                    self.retry_timer = int(response.headers.get("Retry-After", 1))
+                    retry_after = int(response.headers.get("Retry-After", 1))
+                    with self.retry_lock:
+                        self.retry_until = max(
+                            self.retry_until, time.monotonic() + retry_after
+                        )
                     print(
-                        f"Rate limit exceeded for region {self.region}. Retrying after {self.retry_timer} seconds."
+                        f"Rate limit exceeded for region {self.region}. Retrying after {retry_after} seconds."
                     )
-                # If any other error occurs and the retry counter has reached it's limit, then raise the error.
-                elif self.retry_count >= 2:
+                # If it's a server error that hasn't reached the retry limit, then wait exponentially longer and retry.
+                elif response.status_code >= 500 and retry_count < self.max_retries:
+                    time.sleep(2**retry_count)
+                    retry_count += 1
+                # If any other error occurs or the retry counter has reached it's limit, then raise the error.
+                else:
                     raise Exception(
                         f"Error: {response.status_code} response from {url}"
                     )
-                # Else, just increase the retry count.
-                else:
-                    self.retry_count += 1
             except RequestException as e:
                 # If a different error occured, print the error, wait one second and continue.
                 print(f"Request failed: {e}. Retrying...")
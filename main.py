@@ -1,4 +1,5 @@
 import concurrent.futures
+import itertools
 import requests
 import os
 from dotenv import load_dotenv
@@ -19,6 +20,29 @@ regions = [
     {"sea": ["oc1", "ph2", "sg2", "th2", "tw2", "vn2"]},
 ]
 
+# High elo tiers, fetched as a single league each.
+HIGH_ELOS = ("challenger", "grandmaster", "master")
+# Tiers and divisions fetched page by page, in the order they are fetched.
+TIERS = ("DIAMOND", "EMERALD", "PLATINUM", "GOLD", "SILVER", "BRONZE", "IRON")
+DIVISIONS = ("I", "II", "III", "IV")
+
+# Number of matches fetched at the same time by each main region.
+MATCH_FETCH_WORKERS = 8
+
+
+def fetch_match(fetcher, match_id):
+    """
+    Function to fetch and treat the data of a match, run by the match executor threads.
+
+    Args:
+        fetcher (MainRegionFetcher): Fetcher of the main region the match is from.
+        match_id (string): ID of the match to be fetched.
+
+    Returns:
+        Tuple(Dict, List[Dict], List[Dict]) OR None: Returns the treated match data, or None if the match was aborted.
+    """
+    return treat_match(fetcher.get_match_data(match_id))
+
 
 # Sub Region Worker.
 def sub_region_fetching(region):
@@ -32,12 +56,14 @@ def sub_region_fetching(region):
     try:
         # Create a instance of the class SubRegionFetcher for the current region.
         fetcher = SubRegionFetcher(region)
+        # Single worker for fetching the next rank page while the current one is treated and inserted.
+        page_executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
 
         print(f"Starting sub fetcher {region}")
         # Infinite loop to keep fetching data.
         while True:
             # Get the data from each high-elo.
-            for high_elo in ["challenger", "grandmaster", "master"]:
+            for high_elo in HIGH_ELOS:
 
                 print(f"Starting fetching on tier {high_elo} for region {region}")
 
@@ -63,36 +89,37 @@ def sub_region_fetching(region):
                         f"Error occured while adding main region starting point, error: {e}"
                     )
             # Get the data from each division and tier.
-            # Nested loop for getting all divisions and tiers. Page variable is used to keep track of the current page.
-            for tier in [
-                "DIAMOND",
-                "EMERALD",
-                "PLATINUM",
-                "GOLD",
-                "SILVER",
-                "BRONZE",
-                "IRON",
-            ]:
-                print(f"Starting fetching on tier {tier} for region {region}")
-                try:
-                    for division in ["I", "II", "III", "IV"]:
-                        page = 1
-                        while True:
-                            data = fetcher.get_rank_page(
-                                tier=tier, division=division, page=page
-                            )
-                            # Verify if the division wasn't fully fetched.
-                            # If it was, then go to the next iteration.
-                            if len(data) > 0:
-                                treated_rating = get_rating_list(data, region)
-                                insert_player_rating_list(treated_rating)
-                                page += 1
-                            else:
-                                break
-                except Exception as e:
-                    raise Exception(
-                        f"Error occurred while fetching player rating list: {e}"
+            # Page variable is used to keep track of the current page.
+            try:
+                for tier, division in itertools.product(TIERS, DIVISIONS):
+                    print(
+                        f"Starting fetching on tier {tier} {division} for region {region}"
+                    )
+                    page = 1
+                    next_page = page_executor.submit(
+                        fetcher.get_rank_page, tier=tier, division=division, page=page
                     )
+                    while True:
+                        data = next_page.result()
+                        # Verify if the division wasn't fully fetched.
+                        # If it was, then go to the next iteration.
+                        if len(data) > 0:
+                            page += 1
+                            # Start fetching the next page before treating and inserting the current one.
+                            next_page = page_executor.submit(
+                                fetcher.get_rank_page,
+                                tier=tier,
+                                division=division,
+                                page=page,
+                            )
+                            treated_rating = get_rating_list(data, region)
+                            insert_player_rating_list(treated_rating)
+                        else:
+                            break
+            except Exception as e:
+                raise Exception(
+                    f"Error occurred while fetching player rating list: {e}"
+                )
             print(
                 f"Rating fetching finished for region {region}. Sleeping for 30 minutes."
             )
@@ -140,12 +167,21 @@ def main_region_fetching(region_list: dict):
 
         # Instanciate the fetcher.
         main_fetcher = MainRegionFetcher(cur_region)
+        # Executor for fetching the match data concurrently, the rate limit is still handled by the fetcher.
+        match_executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=MATCH_FETCH_WORKERS
+        )
 
         # Infinite loop for keeping the fetcher running.
         while True:
             print("Starting fetching for the next player...")
-            # Get the next player from this region scope.
-            next_player = get_next_to_fetch(region_list[cur_region])
+            # Get the next player from this region scope, setting the current time as the last time the player data was fetched.
+            next_player = claim_next_to_fetch(region_list[cur_region])
+            # Every candidate player can be locked by other workers, wait and try to claim again.
+            if next_player is None:
+                print(f"No player available to claim for {cur_region}")
+                time.sleep(15)
+                continue
             # Initialize the match list as a empty list and it's starting point.
             match_list = []
             list_size = 0
@@ -163,35 +199,35 @@ def main_region_fetching(region_list: dict):
                 else:
                     break
 
-            # Loop through each match.
-            for match in match_list:
-                # Verify if the match was already in the database, meaning that it was already treated.
-                if match_on_db(match):
-                    continue
-                # Get the match data from the API.
-                match_data = main_fetcher.get_match_data(match)
-                # Get the match, player and stats data.
-                m_info = get_match_info(match_data)
-                if m_info is None:
-                    continue
-                p_info = get_player_info(match_data)
-                p_stats = get_player_stats(match_data)
-
-                # Verify if a player was already on the database before inserting it into the database, so no duplicates can be added.
-                new_p_info = []
-                for player in p_info:
-                    player_exists = update_player_if_exists(
-                        player, m_info["matchStart"]
-                    )
-                    if player_exists == True:
+            # Remove the matches that were already in the database, meaning that they were already treated.
+            known_matches = existing_match_ids(match_list)
+            new_matches = [match for match in match_list if match not in known_matches]
+            # Get and treat the match data from the API concurrently.
+            futures = {
+                match_executor.submit(fetch_match, main_fetcher, match): match
+                for match in new_matches
+            }
+            # Loop through each match as soon as it's data is treated, the database insertion is kept on this thread.
+            # The queued matches are cancelled if the loop stops, so they don't keep using the rate limit of a stopped region.
+            try:
+                for future in concurrent.futures.as_completed(futures):
+                    # A failed match is only logged, so it doesn't stop the remaining matches of the player.
+                    try:
+                        treated_match = future.result()
+                    except Exception as e:
+                        print(
+                            f"Error on match {futures[future]} for region {cur_region}: {e}"
+                        )
+                        continue
+                    if treated_match is None:
                         continue
-                    new_p_info.append(player)
-                # Insert all the data in the database.
-                insert_player_list(new_p_info)
-                insert_match(m_info)
-                insert_stats_list(p_stats)
-            # Set the current time as the last time the player data was fetched.
-            update_last_fetch(next_player["puuid"])
+                    m_info, p_info, p_stats = treated_match
+                    # Insert the match, it's players and stats together, the fetched player isn't updated since it's last fetch was set when claimed.
+                    insert_match_data(m_info, p_info, p_stats, next_player["puuid"])
+            except Exception:
+                for future in futures:
+                    future.cancel()
+                raise
     except Exception as e:
         print(f"Error on main region {cur_region}: {e}")
 
@@ -1,8 +1,34 @@
 import datetime
-from database import rating_up_to_date
+from database import latest_ratings_for
+
+# Module level reference, so the timestamp conversion skips the datetime attribute lookups.
+_fromtimestamp = datetime.datetime.fromtimestamp
+
+
+def safe_treatment(description):
+    """Decorator for the treatment functions. Assure that any error is raised showing which data was being treated.
+    Keeps the error handling out of the treatment loops.
+
+    Args:
+        description (String): Description of the treated data, formatted with the arguments passed to the function.
+    """
+
+    def decorator(func):
+        def wrapper(*args, **kwargs):
+            try:
+                return func(*args, **kwargs)
+            except Exception as e:
+                raise Exception(
+                    f"Error on the treatment of data for {description.format(*args)}: {e}"
+                ) from e
+
+        return wrapper
+
+    return decorator
 
 
 # Get rating information from a rating page.
+@safe_treatment("rating list")
 def get_rating_list(rating_response, region, high_rank=False):
     """Function to get the list of ratings for a given league page.
 
@@ -14,27 +40,29 @@ def get_rating_list(rating_response, region, high_rank=False):
     Returns:
         List[Dict]: Returns the list of dictionaries with the treated data.
     """
-    try:
-        rating_list = []
-        for rating in rating_response["entries"] if high_rank else rating_response:
-            new_rating = {
-                "tier": rating_response["tier"] if high_rank else rating["tier"],
-                "rank": rating["rank"],
-                "wins": rating["wins"],
-                "losses": rating["losses"],
-                "leaguePoints": rating["leaguePoints"],
-                "summonerId": rating["summonerId"],
-                "region": region,
-            }
-            if not rating_up_to_date(new_rating):
-                rating_list.append(new_rating)
-
-        return rating_list
-    except Exception as e:
-        raise Exception(f"Error on the treatment of data for rating list: {e}")
+    entries = rating_response["entries"] if high_rank else rating_response
+    # Get the last rating of every summoner on the page with a single query.
+    latest_ratings = latest_ratings_for([rating["summonerId"] for rating in entries])
+    get_latest = latest_ratings.get
+    # Only build the ratings that changed since the last fetch, the unchanged ones are skipped before any allocation.
+    return [
+        {
+            "tier": rating_response["tier"] if high_rank else rating["tier"],
+            "rank": rating["rank"],
+            "wins": rating["wins"],
+            "losses": rating["losses"],
+            "leaguePoints": rating["leaguePoints"],
+            "summonerId": rating["summonerId"],
+            "region": region,
+        }
+        for rating in entries
+        if get_latest(rating["summonerId"])
+        != (rating["leaguePoints"], rating["wins"], rating["losses"])
+    ]
 
 
 # Get very simple match info and let it structured to insert directly into the database.
+@safe_treatment("match {0[metadata][matchId]}")
 def get_match_info(data):
     """
     Function to get simplified information from a match.
@@ -45,32 +73,25 @@ def get_match_info(data):
     Returns:
         dict: Filtered dictionary with useful information from the match.
     """
-    try:
-        if data["info"]["endOfGameResult"] != "Abort_Unexpected":
-            match_info = {
-                "gameVersion": data["info"]["gameVersion"],
-                "matchId": data["metadata"]["matchId"],
-                "matchStart": datetime.datetime.fromtimestamp(
-                    data["info"]["gameCreation"] / 1000
-                ),
-                "matchDuration": data["info"]["gameDuration"],
-                "matchWinner": not data["info"]["teams"][0]["win"],
-                "matchSurrender": data["info"]["participants"][0][
-                    "gameEndedInSurrender"
-                ],
-                "matchRemake": data["info"]["participants"][0][
-                    "gameEndedInEarlySurrender"
-                ],
-            }
-            return match_info
-        else:
-            return None
-    except Exception as e:
-        match_id = data["metadata"]["matchId"]
-        raise Exception(f"Error on the treatment of data for match {match_id}: {e}")
+    info = data["info"]
+    if info["endOfGameResult"] == "Abort_Unexpected":
+        return None
+    first_participant = info["participants"][0]
+    match_info = {
+        "gameVersion": info["gameVersion"],
+        "matchId": data["metadata"]["matchId"],
+        # The creation is in milliseconds, multiplying is cheaper than dividing.
+        "matchStart": _fromtimestamp(info["gameCreation"] * 0.001),
+        "matchDuration": info["gameDuration"],
+        "matchWinner": not info["teams"][0]["win"],
+        "matchSurrender": first_participant["gameEndedInSurrender"],
+        "matchRemake": first_participant["gameEndedInEarlySurrender"],
+    }
+    return match_info
 
 
 # Get very simple player info and structure it to insert into the database..
+@safe_treatment("player information")
 def get_player_info(data):
     """
     Function to get simple player information and structure it.
@@ -81,26 +102,26 @@ def get_player_info(data):
     Returns:
         List[Dict]: Returns a list of dictionaries, each containing the information about a player that was on a given match.
     """
-    try:
-        player_array = []
-        # Loop through each participant and fetch it's data.
-        for participant in data["info"]["participants"]:
-            player_info = {
-                "puuid": participant["puuid"],
-                "summonerId": participant["summonerId"],
-                "gameName": participant["riotIdGameName"],
-                "tagLine": participant["riotIdTagline"],
-                "profileIconId": participant["profileIcon"],
-                "summonerLevel": participant["summonerLevel"],
-                "region": data["info"]["platformId"],
-            }
-            player_array.append(player_info)
-        return player_array
-    except Exception as e:
-        raise Exception(f"Error on the treatment of data for player information: {e}")
+    info = data["info"]
+    # The region is the same for every participant.
+    platform = info["platformId"]
+    # Get the data of each participant.
+    return [
+        {
+            "puuid": participant["puuid"],
+            "summonerId": participant["summonerId"],
+            "gameName": participant["riotIdGameName"],
+            "tagLine": participant["riotIdTagline"],
+            "profileIconId": participant["profileIcon"],
+            "summonerLevel": participant["summonerLevel"],
+            "region": platform,
+        }
+        for participant in info["participants"]
+    ]
 
 
 # Get informations from each player of a game and return it as a array.
+@safe_treatment("player stats list")
 def get_player_stats(data):
     """
     Function to get the stats for each player of a game.
@@ -111,73 +132,94 @@ def get_player_stats(data):
     Returns:
         List[Dict]: Returns a list of dictionaries with the stats of each player.
     """
-    try:
-        player_array = []
-        # Loop through each participant and fetch it's data.
-        for participant in data["info"]["participants"]:
-            player_stats = {
-                # Imutable global ID, unique for each account.
-                "playerId": participant["puuid"],
-                # ID of a given match. Should appear 10 times, one for each player.
-                "matchId": data["metadata"]["matchId"],
-                "championId": participant[
-                    "championId"
-                ],  # ID of the champion played by the player.
-                # KDA information.
-                "kills": participant["kills"],
-                "deaths": participant["deaths"],
-                "assists": participant["assists"],
-                # Gold stats.
-                "goldEarned": participant["goldEarned"],
-                "goldSpent": participant["goldSpent"],
-                # Damage stats.
-                "totalDamage": participant["totalDamageDealtToChampions"],
-                # Items.
-                "item0": participant["item0"],
-                "item1": participant["item1"],
-                "item2": participant["item2"],
-                "item3": participant["item3"],
-                "item4": participant["item4"],
-                "item5": participant["item5"],
-                "item6": participant["item6"],
-                # Runes.
-                "defense": participant["perks"]["statPerks"]["defense"],
-                "flex": participant["perks"]["statPerks"]["flex"],
-                "offense": participant["perks"]["statPerks"]["offense"],
-                "runeTree": participant["perks"]["styles"][0]["style"],
-                "main0": participant["perks"]["styles"][0]["selections"][0]["perk"],
-                "main1": participant["perks"]["styles"][0]["selections"][1]["perk"],
-                "main2": participant["perks"]["styles"][0]["selections"][2]["perk"],
-                "main3": participant["perks"]["styles"][0]["selections"][3]["perk"],
-                "subTree": participant["perks"]["styles"][1]["style"],
-                "sub1": participant["perks"]["styles"][1]["selections"][0]["perk"],
-                "sub2": participant["perks"]["styles"][1]["selections"][1]["perk"],
-                # Spells:
-                "spell1": participant["summoner1Id"],
-                "spell2": participant["summoner2Id"],
-                # Farm and vision stats.
-                "neutralMinionsKilled": participant["neutralMinionsKilled"],
-                "totalMinionsKilled": participant["totalMinionsKilled"],
-                "totalCs": int(
-                    participant["totalMinionsKilled"]
-                )  # Calculation between the total minions and neutral minions killed.
-                + int(participant["neutralMinionsKilled"]),
-                "csPerMin": (
-                    int(participant["totalMinionsKilled"])
-                    + int(participant["neutralMinionsKilled"])
-                )
-                / (int(data["info"]["gameDuration"]) / 60),
-                # Vision stats.
-                "visionScore": participant["visionScore"],
-                "controlWardsPlaced": participant["challenges"]["controlWardsPlaced"],
-                "wardsPlaced": participant["wardsPlaced"],
-                "wardsKilled": participant["wardsKilled"],
-                # Game informations.
-                "teamPosition": participant["teamPosition"],
-                # Player team, if it equals 200, return true, otherwise 0. Blue team is stored as 0 and red as 1 on the Database.
-                "team": participant["teamId"] == 200,
-            }
-            player_array.append(player_stats)
-        return player_array
-    except Exception as e:
-        raise Exception(f"Error on the treatment of data for player stats list: {e}")
+    # Values shared by all the participants.
+    match_id = data["metadata"]["matchId"]
+    info = data["info"]
+    # Inverse of the game duration in minutes, so the cs per minute is a single multiplication.
+    inv_minutes = 60 / info["gameDuration"]
+    player_array = []
+    append_player = player_array.append
+    # Loop through each participant and fetch it's data.
+    for participant in info["participants"]:
+        perks = participant["perks"]
+        stat_perks = perks["statPerks"]
+        main_style, sub_style = perks["styles"][0], perks["styles"][1]
+        main_selections = main_style["selections"]
+        sub_selections = sub_style["selections"]
+        # Calculation between the total minions and neutral minions killed.
+        total_cs = (
+            participant["totalMinionsKilled"] + participant["neutralMinionsKilled"]
+        )
+        player_stats = {
+            # Imutable global ID, unique for each account.
+            "playerId": participant["puuid"],
+            # ID of a given match. Should appear 10 times, one for each player.
+            "matchId": match_id,
+            "championId": participant[
+                "championId"
+            ],  # ID of the champion played by the player.
+            # KDA information.
+            "kills": participant["kills"],
+            "deaths": participant["deaths"],
+            "assists": participant["assists"],
+            # Gold stats.
+            "goldEarned": participant["goldEarned"],
+            "goldSpent": participant["goldSpent"],
+            # Damage stats.
+            "totalDamage": participant["totalDamageDealtToChampions"],
+            # Items.
+            "item0": participant["item0"],
+            "item1": participant["item1"],
+            "item2": participant["item2"],
+            "item3": participant["item3"],
+            "item4": participant["item4"],
+            "item5": participant["item5"],
+            "item6": participant["item6"],
+            # Runes.
+            "defense": stat_perks["defense"],
+            "flex": stat_perks["flex"],
+            "offense": stat_perks["offense"],
+            "runeTree": main_style["style"],
+            "main0": main_selections[0]["perk"],
+            "main1": main_selections[1]["perk"],
+            "main2": main_selections[2]["perk"],
+            "main3": main_selections[3]["perk"],
+            "subTree": sub_style["style"],
+            "sub1": sub_selections[0]["perk"],
+            "sub2": sub_selections[1]["perk"],
+            # Spells:
+            "spell1": participant["summoner1Id"],
+            "spell2": participant["summoner2Id"],
+            # Farm and vision stats.
+            "neutralMinionsKilled": participant["neutralMinionsKilled"],
+            "totalMinionsKilled": participant["totalMinionsKilled"],
+            "totalCs": total_cs,
+            "csPerMin": total_cs * inv_minutes,
+            # Vision stats.
+            "visionScore": participant["visionScore"],
+            "controlWardsPlaced": participant["challenges"]["controlWardsPlaced"],
+            "wardsPlaced": participant["wardsPlaced"],
+            "wardsKilled": participant["wardsKilled"],
+            # Game informations.
+            "teamPosition": participant["teamPosition"],
+            # Player team, if it equals 200, return true, otherwise 0. Blue team is stored as 0 and red as 1 on the Database.
+            "team": participant["teamId"] == 200,
+        }
+        append_player(player_stats)
+    return player_array
+
+
+def treat_match(data):
+    """
+    Function to get all the treated data from a match.
+
+    Args:
+        data (dict): Receives a dict containing the data of a given match.
+
+    Returns:
+        Tuple(Dict, List[Dict], List[Dict]) OR None: Returns the match info, player info and player stats, or None if the match was aborted.
+    """
+    match_info = get_match_info(data)
+    if match_info is None:
+        return None
+    return match_info, get_player_info(data), get_player_stats(data)